@@ -35,23 +35,31 @@ Support for building and installing Clang, implemented as an easyblock.
 @author: Maxime Boissonneault (Digital Research Alliance of Canada, Universite Laval)
 """
 
+import fnmatch
 import glob
 import os
+import re
 import shutil
+from contextlib import contextmanager
 from easybuild.tools import LooseVersion
 
 from easybuild.easyblocks.generic.cmakemake import CMakeMake
+from easybuild.easyblocks.generic.configuremake import DEFAULT_BUILD_CMD, DEFAULT_INSTALL_CMD
 from easybuild.framework.easyconfig import CUSTOM
 from easybuild.toolchains.compiler.clang import Clang
 from easybuild.tools import run
 from easybuild.tools.build_log import EasyBuildError, print_warning
 from easybuild.tools.config import build_option
-from easybuild.tools.filetools import apply_regex_substitutions, change_dir, mkdir, symlink, which
+from easybuild.tools.filetools import apply_regex_substitutions, change_dir, mkdir, read_file, symlink, which
+from easybuild.tools.filetools import write_file
 from easybuild.tools.modules import get_software_root
 from easybuild.tools.run import run_cmd
-from easybuild.tools.systemtools import AARCH32, AARCH64, POWER, RISCV64, X86_64
+from easybuild.tools.systemtools import AARCH32, AARCH64, POWER, RISCV64, UNKNOWN, X86_64
 from easybuild.tools.systemtools import get_cpu_architecture, get_os_name, get_os_version, get_shared_lib_ext
+from easybuild.tools.systemtools import get_total_memory
 from easybuild.tools.environment import setvar
+from easybuild.tools.py2vs3 import string_type
+from easybuild.tools.utilities import nub
 
 # List of all possible build targets for Clang
 CLANG_TARGETS = ["all", "AArch64", "AMDGPU", "ARM", "CppBackend", "Hexagon", "Mips",
@@ -76,6 +84,13 @@ AMDGPU_GFX_SUPPORT = ['gfx700', 'gfx701', 'gfx801', 'gfx803', 'gfx900',
 CUDA_TOOLKIT_SUPPORT = ['80', '90', '91', '92', '100', '101', '102', '110', '111', '112']
 
 
+# Regular expression for entries in CMakeCache.txt of checks for system features (name, type, value)
+CMAKE_CACHE_HAVE_VAR_REGEX = re.compile(r'^(HAVE_\w+):(\w+)=(.*)$', re.M)
+
+# Regular expression for LLVM_USE_LINKER option in configure options (linker name, which may be quoted)
+LLVM_USE_LINKER_REGEX = re.compile(r"-DLLVM_USE_LINKER(?::\w+)?=['\"]?([^\s'\"]+)")
+
+
 # When extending the lists below, make sure to add additional sanity checks!
 # List of the known LLVM projects
 KNOWN_LLVM_PROJECTS = ['llvm', 'clang', 'polly', 'lld', 'lldb', 'clang-tools-extra', 'flang']
@@ -83,6 +98,77 @@ KNOWN_LLVM_PROJECTS = ['llvm', 'clang', 'polly', 'lld', 'lldb', 'clang-tools-ext
 KNOWN_LLVM_RUNTIMES = ['compiler-rt', 'libunwind', 'libcxx', 'libcxxabi', 'openmp']
 
 
+def det_llvm_parallel_jobs(parallel):
+    """
+    Determine maximum number of concurrent compile and link jobs to use when building LLVM with Ninja
+    (via LLVM_PARALLEL_COMPILE_JOBS and LLVM_PARALLEL_LINK_JOBS), taking into account the available memory
+
+    :param parallel: maximum number of parallel build jobs
+    :return: tuple with maximum number of concurrent compile jobs and link jobs
+    """
+    compile_jobs, link_jobs = parallel, max(1, parallel // 4)
+
+    total_mem = get_total_memory()
+    if total_mem not in (None, UNKNOWN):
+        total_mem_gb = total_mem // 1024
+        # compiling LLVM sources can take up to ~2GB of memory per job,
+        # linking the LLVM libraries and tools up to ~15GB per job
+        compile_jobs = max(1, min(parallel, total_mem_gb // 2))
+        link_jobs = max(1, min(parallel, total_mem_gb // 15))
+
+    return compile_jobs, link_jobs
+
+
+def det_llvm_build_type_configopts(build_type):
+    """
+    Determine additional configure options for LLVM that depend on the CMake build type
+
+    :param build_type: CMake build type (e.g. Release, Debug)
+    :return: list of configure options
+    """
+    configopts = []
+
+    # for debug builds, let LLVM build an optimized TableGen to use during the build,
+    # since processing all the .td files with an unoptimized TableGen takes a long time
+    if build_type == 'Debug':
+        configopts.append('-DLLVM_OPTIMIZED_TABLEGEN=ON')
+
+    return configopts
+
+
+def setup_llvm_ninja(easyblock):
+    """
+    Set up building LLVM with Ninja rather than Make for the specified (CMakeMake-based) easyblock,
+    if Ninja is available as a (build) dependency, since it copes a lot better with the (very large) build graph;
+    when Ninja is used, the number of concurrent compile/link jobs is also limited based on the available memory,
+    to avoid running out of memory (or swapping) when building with lots of cores
+
+    :param easyblock: easyblock instance to set up (easyconfig parameters and configure options are updated)
+    """
+    cfg = easyblock.cfg
+
+    if cfg['generator'] is None and get_software_root('Ninja'):
+        cfg['generator'] = 'Ninja'
+
+    if cfg['generator'] == 'Ninja':
+        ninja = which('ninja')
+        if ninja:
+            easyblock.prepend_config_opts({'CMAKE_MAKE_PROGRAM': "'%s'" % ninja})
+        if cfg['build_cmd'] == DEFAULT_BUILD_CMD:
+            cfg['build_cmd'] = 'ninja'
+        if cfg['install_cmd'] == DEFAULT_INSTALL_CMD:
+            cfg['install_cmd'] = 'ninja install'
+        if isinstance(cfg['runtest'], string_type) and not cfg['test_cmd']:
+            cfg['test_cmd'] = 'ninja'
+
+        if cfg['parallel']:
+            compile_jobs, link_jobs = det_llvm_parallel_jobs(int(cfg['parallel']))
+            easyblock.prepend_config_opts({
+                'LLVM_PARALLEL_COMPILE_JOBS': compile_jobs,
+                'LLVM_PARALLEL_LINK_JOBS': link_jobs,
+            })
+
+
 class EB_Clang(CMakeMake):
     """Support for bootstrapping Clang."""
 
@@ -94,6 +180,7 @@ class EB_Clang(CMakeMake):
                              ', '.join(AMDGPU_GFX_SUPPORT), CUSTOM],
             'assertions': [True, "Enable assertions.  Helps to catch bugs in Clang.", CUSTOM],
             'bootstrap': [True, "Bootstrap Clang using GCC", CUSTOM],
+            'bootstrap_thin_lto': [False, "Use ThinLTO for stage 2 and 3 of the bootstrap (requires lld)", CUSTOM],
             'build_extra_clang_tools': [False, "Build extra Clang tools", CUSTOM],
             'build_lld': [False, "Build the LLVM lld linker", CUSTOM],
             'build_lldb': [False, "Build the LLVM lldb debugger", CUSTOM],
@@ -102,6 +189,7 @@ class EB_Clang(CMakeMake):
             'default_cuda_capability': [None, "Default CUDA capability specified for clang, e.g. '7.5'", CUSTOM],
             'default_openmp_runtime': [None, "Default OpenMP runtime for clang (for example, 'libomp')", CUSTOM],
             'enable_rtti': [False, "Enable Clang RTTI", CUSTOM],
+            'use_clang_modules': [False, "Build stage 2 and 3 of the bootstrap using Clang header modules", CUSTOM],
             'python_bindings': [False, "Install python bindings", CUSTOM],
             'libcxx': [False, "Build the LLVM C++ standard library", CUSTOM],
             'skip_all_tests': [False, "Skip running of tests", CUSTOM],
@@ -151,8 +239,10 @@ class EB_Clang(CMakeMake):
             self.log.warning(msg)
             print_warning(msg)
 
+        version = LooseVersion(self.version)
+
         # keep compatibility between using llvm_projects/llvm_runtimes vs using flags
-        if LooseVersion(self.version) >= LooseVersion('14'):
+        if version >= '14':
             self.cfg.update('llvm_projects', ['llvm', 'clang'], allow_duplicate=False)
             self.cfg.update('llvm_runtimes', ['compiler-rt', 'openmp'], allow_duplicate=False)
             if self.cfg['usepolly']:
@@ -175,6 +265,26 @@ class EB_Clang(CMakeMake):
         if 'libcxx' in self.cfg['llvm_runtimes']:
             self.cfg.update('llvm_runtimes', 'libcxxabi', allow_duplicate=False)
 
+        # Clang header modules can only be used for stage 2 and 3 (stage 1 is built with GCC)
+        if self.cfg['use_clang_modules'] and not self.cfg['bootstrap']:
+            msg = "Enabling 'use_clang_modules' has no effect when 'bootstrap' is disabled"
+            self.log.warning(msg)
+            print_warning(msg)
+
+        # ThinLTO requires a linker that supports LLVM bitcode, so we use lld from the previous stage
+        if self.cfg['bootstrap_thin_lto']:
+            if not self.cfg['bootstrap']:
+                msg = "Enabling 'bootstrap_thin_lto' has no effect when 'bootstrap' is disabled"
+                self.log.warning(msg)
+                print_warning(msg)
+            else:
+                if 'lld' not in self.cfg['llvm_projects']:
+                    raise EasyBuildError("Using ThinLTO for the bootstrap stages requires that lld is built as well")
+                linker = LLVM_USE_LINKER_REGEX.search(self.cfg['configopts'])
+                if linker and linker.group(1) != 'lld':
+                    raise EasyBuildError("Using ThinLTO for the bootstrap stages requires lld as linker, "
+                                         "found '%s' in configopts", linker.group(0))
+
         build_targets = self.cfg['build_targets']
         # define build_targets if not set
         if build_targets is None:
@@ -208,10 +318,10 @@ class EB_Clang(CMakeMake):
             raise EasyBuildError("Some of the chosen build targets (%s) are not in %s.",
                                  ', '.join(unknown_targets), ', '.join(CLANG_TARGETS))
 
-        if LooseVersion(self.version) < LooseVersion('3.4') and "R600" in build_targets:
+        if version < '3.4' and "R600" in build_targets:
             raise EasyBuildError("Build target R600 not supported in < Clang-3.4")
 
-        if LooseVersion(self.version) > LooseVersion('3.3') and "MBlaze" in build_targets:
+        if version > '3.3' and "MBlaze" in build_targets:
             raise EasyBuildError("Build target MBlaze is not supported anymore in > Clang-3.3")
 
     def check_readiness_step(self):
@@ -230,6 +340,8 @@ class EB_Clang(CMakeMake):
         # Extract everything into separate directories.
         super(EB_Clang, self).extract_step()
 
+        version = LooseVersion(self.version)
+
         # Find the full path to the directory that was unpacked from llvm-*.tar.gz.
         for tmp in self.src:
             if tmp['name'].startswith("llvm-"):
@@ -240,13 +352,21 @@ class EB_Clang(CMakeMake):
             raise EasyBuildError("Could not determine LLVM source root (LLVM source was not unpacked?)")
 
         src_dirs = {}
+        # cache of directory listings, so we only need to list the contents of each directory once
+        dir_entries = {}
 
         def find_source_dir(globpatterns, targetdir):
             """Search for directory with globpattern and rename it to targetdir"""
             if not isinstance(globpatterns, list):
                 globpatterns = [globpatterns]
 
-            glob_src_dirs = [glob_dir for globpattern in globpatterns for glob_dir in glob.glob(globpattern)]
+            glob_src_dirs = []
+            for globpattern in globpatterns:
+                parent_dir, pattern = os.path.split(globpattern)
+                if parent_dir not in dir_entries:
+                    dir_entries[parent_dir] = sorted(os.listdir(parent_dir or os.curdir))
+                matches = fnmatch.filter(dir_entries[parent_dir], pattern)
+                glob_src_dirs.extend(os.path.join(parent_dir, x) for x in matches)
             if len(glob_src_dirs) != 1:
                 raise EasyBuildError("Failed to find exactly one source directory for pattern %s: %s", globpatterns,
                                      glob_src_dirs)
@@ -280,7 +400,7 @@ class EB_Clang(CMakeMake):
 
             if 'lld' in self.cfg['llvm_projects']:
                 find_source_dir('lld-*', os.path.join(self.llvm_src_dir, 'tools', 'lld'))
-                if LooseVersion(self.version) >= LooseVersion('12.0.1'):
+                if version >= '12.0.1':
                     find_source_dir('libunwind-*', os.path.normpath(os.path.join(self.llvm_src_dir, '..', 'libunwind')))
 
             if 'lldb' in self.cfg['llvm_projects']:
@@ -296,7 +416,7 @@ class EB_Clang(CMakeMake):
                 find_source_dir('clang-tools-extra-*',
                                 os.path.join(self.llvm_src_dir, 'tools', 'clang', 'tools', 'extra'))
 
-            if LooseVersion(self.version) >= LooseVersion('3.8'):
+            if version >= '3.8':
                 find_source_dir('openmp-*', os.path.join(self.llvm_src_dir, 'projects', 'openmp'))
 
         for src in self.src:
@@ -321,7 +441,9 @@ class EB_Clang(CMakeMake):
             self.llvm_obj_dir_stage2 = os.path.join(self.builddir, 'llvm.obj.2')
             self.llvm_obj_dir_stage3 = os.path.join(self.builddir, 'llvm.obj.3')
 
-        if LooseVersion(self.version) >= LooseVersion('3.3'):
+        version = LooseVersion(self.version)
+
+        if version >= '3.3':
             disable_san_tests = False
             # all sanitizer tests will fail when there's a limit on the vmem
             # this is ugly but I haven't found a cleaner way so far
@@ -361,45 +483,58 @@ class EB_Clang(CMakeMake):
         if gcc_prefix is None:
             raise EasyBuildError("Can't find GCC or GCCcore to use")
 
-        self.cfg.update('configopts', "-DGCC_INSTALL_PREFIX='%s'" % gcc_prefix)
+        # collect configure options, and add them to configopts in one go
+        configopts = ["-DGCC_INSTALL_PREFIX='%s'" % gcc_prefix]
         self.log.debug("Using %s as GCC_INSTALL_PREFIX", gcc_prefix)
 
         # Configure some default options
         if self.cfg["enable_rtti"]:
-            self.cfg.update('configopts', '-DLLVM_REQUIRES_RTTI=ON')
-            self.cfg.update('configopts', '-DLLVM_ENABLE_RTTI=ON')
-            self.cfg.update('configopts', '-DLLVM_ENABLE_EH=ON')
+            configopts.append('-DLLVM_REQUIRES_RTTI=ON')
+            configopts.append('-DLLVM_ENABLE_RTTI=ON')
+            configopts.append('-DLLVM_ENABLE_EH=ON')
         if self.cfg["default_openmp_runtime"]:
-            self.cfg.update(
-                'configopts',
-                '-DCLANG_DEFAULT_OPENMP_RUNTIME=%s' % self.cfg["default_openmp_runtime"]
-            )
+            configopts.append('-DCLANG_DEFAULT_OPENMP_RUNTIME=%s' % self.cfg["default_openmp_runtime"])
 
         if self.cfg['assertions']:
-            self.cfg.update('configopts', "-DLLVM_ENABLE_ASSERTIONS=ON")
+            configopts.append("-DLLVM_ENABLE_ASSERTIONS=ON")
         else:
-            self.cfg.update('configopts', "-DLLVM_ENABLE_ASSERTIONS=OFF")
+            configopts.append("-DLLVM_ENABLE_ASSERTIONS=OFF")
+
+        configopts.extend(det_llvm_build_type_configopts(self.build_type))
 
         if 'polly' in self.cfg['llvm_projects']:
             # Not exactly sure when this change took place, educated guess
-            if LooseVersion(self.version) >= LooseVersion('14'):
-                self.cfg.update('configopts', "-DLLVM_POLLY_LINK_INTO_TOOLS=ON")
+            if version >= '14':
+                configopts.append("-DLLVM_POLLY_LINK_INTO_TOOLS=ON")
             else:
-                self.cfg.update('configopts', "-DLINK_POLLY_INTO_TOOLS=ON")
+                configopts.append("-DLINK_POLLY_INTO_TOOLS=ON")
 
         # If Z3 is included as a dep, enable support in static analyzer (if enabled)
-        if self.cfg["static_analyzer"] and LooseVersion(self.version) >= LooseVersion('9.0.0'):
+        if self.cfg["static_analyzer"] and version >= '9.0.0':
             z3_root = get_software_root("Z3")
             if z3_root:
-                self.cfg.update('configopts', "-DLLVM_ENABLE_Z3_SOLVER=ON")
-                self.cfg.update('configopts', "-DLLVM_Z3_INSTALL_DIR=%s" % z3_root)
+                configopts.append("-DLLVM_ENABLE_Z3_SOLVER=ON")
+                configopts.append("-DLLVM_Z3_INSTALL_DIR=%s" % z3_root)
 
         build_targets = self.cfg['build_targets']
 
         if 'polly' in self.cfg['llvm_projects'] and "NVPTX" in build_targets:
-            self.cfg.update('configopts', "-DPOLLY_ENABLE_GPGPU_CODEGEN=ON")
-
-        self.cfg.update('configopts', '-DLLVM_TARGETS_TO_BUILD="%s"' % ';'.join(build_targets))
+            configopts.append("-DPOLLY_ENABLE_GPGPU_CODEGEN=ON")
+
+        # when bootstrapping, stage 1 is only used to build stage 2, so it only needs the backend for the host
+        # architecture, and the GPU backends that are required to build the OpenMP offload runtimes in stage 2;
+        # stage 2 and 3 are built for the full list of build targets (see build_with_prev_stage)
+        stage1_targets = build_targets
+        host_targets = DEFAULT_TARGETS_MAP.get(get_cpu_architecture())
+        if self.cfg['bootstrap'] and host_targets:
+            if 'all' in build_targets:
+                if version >= '3.9':
+                    stage1_targets = host_targets + ['NVPTX', 'AMDGPU']
+            elif all(t in build_targets for t in host_targets):
+                stage1_targets = [t for t in build_targets if t in host_targets + ['NVPTX', 'AMDGPU']]
+            self.log.info("Using %s as build targets for stage 1", stage1_targets)
+
+        configopts.append('-DLLVM_TARGETS_TO_BUILD="%s"' % ';'.join(stage1_targets))
 
         if self.cfg['parallel']:
             self.make_parallel_opts = "-j %s" % self.cfg['parallel']
@@ -407,17 +542,12 @@ class EB_Clang(CMakeMake):
         # If hwloc is included as a dep, use it in OpenMP runtime for affinity
         hwloc_root = get_software_root('hwloc')
         if hwloc_root:
-            self.cfg.update('configopts', '-DLIBOMP_USE_HWLOC=ON')
-            self.cfg.update('configopts', '-DLIBOMP_HWLOC_INSTALL_DIR=%s' % hwloc_root)
+            configopts.append('-DLIBOMP_USE_HWLOC=ON')
+            configopts.append('-DLIBOMP_HWLOC_INSTALL_DIR=%s' % hwloc_root)
 
         # If 'NVPTX' is in the build targets we assume the user would like OpenMP offload support as well
         if 'NVPTX' in build_targets:
-            # list of CUDA compute capabilities to use can be specifed in two ways (where (2) overrules (1)):
-            # (1) in the easyconfig file, via the custom cuda_compute_capabilities;
-            # (2) in the EasyBuild configuration, via --cuda-compute-capabilities configuration option;
-            ec_cuda_cc = self.cfg['cuda_compute_capabilities']
-            cfg_cuda_cc = build_option('cuda_compute_capabilities')
-            cuda_cc = cfg_cuda_cc or ec_cuda_cc or []
+            cuda_cc = self.get_cuda_compute_capabilities()
             if not cuda_cc:
                 raise EasyBuildError("Can't build Clang with CUDA support "
                                      "without specifying 'cuda-compute-capabilities'")
@@ -425,10 +555,10 @@ class EB_Clang(CMakeMake):
             if not self.cfg['default_cuda_capability']:
                 print_warning("No default CUDA capability defined! "
                               "Using '%s' taken as minimum from 'cuda_compute_capabilities'" % default_cc)
-            cuda_cc = [cc.replace('.', '') for cc in cuda_cc]
-            default_cc = default_cc.replace('.', '')
-            self.cfg.update('configopts', '-DCLANG_OPENMP_NVPTX_DEFAULT_ARCH=sm_%s' % default_cc)
-            self.cfg.update('configopts', '-DLIBOMPTARGET_NVPTX_COMPUTE_CAPABILITIES=%s' % ','.join(cuda_cc))
+            cuda_sm = [cc.replace('.', '') for cc in cuda_cc]
+            default_sm = default_cc.replace('.', '')
+            configopts.append('-DCLANG_OPENMP_NVPTX_DEFAULT_ARCH=sm_%s' % default_sm)
+            configopts.append('-DLIBOMPTARGET_NVPTX_COMPUTE_CAPABILITIES=%s' % ','.join(cuda_sm))
         # If we don't want to build with CUDA (not in dependencies) trick CMakes FindCUDA module into not finding it by
         # using the environment variable which is used as-is and later checked for a falsy value when determining
         # whether CUDA was found
@@ -443,19 +573,65 @@ class EB_Clang(CMakeMake):
             if not ec_amdgfx:
                 raise EasyBuildError("Can't build Clang with AMDGPU support "
                                      "without specifying 'amd_gfx_list'")
-            self.cfg.update('configopts', '-DLIBOMPTARGET_AMDGCN_GFXLIST=%s' % ' '.join(ec_amdgfx))
+            configopts.append('-DLIBOMPTARGET_AMDGCN_GFXLIST=%s' % ' '.join(ec_amdgfx))
+
+        self.cfg.update('configopts', ' '.join(configopts))
+
+        # don't include targets for examples, benchmarks and documentation (unless configured otherwise),
+        # which are not installed anyway, to prune the (very large) build graph
+        self.prepend_config_opts({
+            'LLVM_INCLUDE_EXAMPLES': 'OFF',
+            'LLVM_INCLUDE_BENCHMARKS': 'OFF',
+            'LLVM_INCLUDE_DOCS': 'OFF',
+            'CLANG_INCLUDE_DOCS': 'OFF',
+        })
+
+        # use Ninja if it is available; the generator and configure options are also used for stage 2 and 3
+        setup_llvm_ninja(self)
+
+        # make ccache (used for all stages, see also build_with_prev_stage) as effective as possible:
+        # use paths relative to the build directory in the hashes, hash the compiler binary by content
+        # (since the Clang compilers of stage 2 and 3 are rebuilt from scratch), and ignore timestamps;
+        # values that are already set in the environment are retained
+        if build_option('use_ccache'):
+            ccache_sloppiness = ['pch_defines', 'time_macros', 'include_file_mtime', 'include_file_ctime']
+            ccache_env = {
+                'CCACHE_BASEDIR': self.builddir,
+                'CCACHE_COMPILERCHECK': 'content',
+            }
+            # ccache only caches compilations that use Clang header modules (-fmodules, see use_clang_modules)
+            # in depend mode, and if 'modules' is included in the sloppiness settings
+            if self.cfg['use_clang_modules']:
+                ccache_sloppiness.append('modules')
+                ccache_env['CCACHE_DEPEND'] = '1'
+            ccache_env['CCACHE_SLOPPINESS'] = ','.join(ccache_sloppiness)
+            for (key, val) in sorted(ccache_env.items()):
+                if os.getenv(key) is None:
+                    setvar(key, val)
 
         self.log.info("Configuring")
 
         # directory structure has changed in version 14.x, cmake must start in llvm sub directory
-        if LooseVersion(self.version) >= LooseVersion('14'):
+        if version >= '14':
             super(EB_Clang, self).configure_step(srcdir=os.path.join(self.llvm_src_dir, "llvm"))
         else:
             super(EB_Clang, self).configure_step(srcdir=self.llvm_src_dir)
 
+    def get_cuda_compute_capabilities(self):
+        """
+        Determine list of CUDA compute capabilities to use, which can be specifed in two ways
+        (where (2) overrules (1)):
+        (1) in the easyconfig file, via the custom cuda_compute_capabilities;
+        (2) in the EasyBuild configuration, via --cuda-compute-capabilities configuration option;
+        """
+        ec_cuda_cc = self.cfg['cuda_compute_capabilities']
+        cfg_cuda_cc = build_option('cuda_compute_capabilities')
+        return cfg_cuda_cc or ec_cuda_cc or []
+
     def disable_sanitizer_tests(self):
         """Disable the tests of all the sanitizers by removing the test directories from the build system"""
-        if LooseVersion(self.version) < LooseVersion('3.6'):
+        version = LooseVersion(self.version)
+        if version < '3.6':
             # for Clang 3.5 and lower, the tests are scattered over several CMakeLists.
             # We loop over them, and patch out the rule that adds the sanitizers tests to the testsuite
             patchfiles = ['lib/asan', 'lib/dfsan', 'lib/lsan', 'lib/msan', 'lib/tsan', 'lib/ubsan']
@@ -474,18 +650,34 @@ class EB_Clang(CMakeMake):
         else:
             # In Clang 3.6, the sanitizer tests are grouped together in one CMakeLists
             # We patch out adding the subdirectories with the sanitizer tests
-            if LooseVersion(self.version) >= LooseVersion('14'):
+            if version >= '14':
                 cmakelists_tests = os.path.join(self.llvm_src_dir, 'compiler-rt', 'test', 'CMakeLists.txt')
             else:
                 cmakelists_tests = os.path.join(self.llvm_src_dir, 'projects', 'compiler-rt', 'test', 'CMakeLists.txt')
             regex_subs = []
-            if LooseVersion(self.version) >= LooseVersion('5.0'):
+            if version >= '5.0':
                 regex_subs.append((r'compiler_rt_test_runtime.*san.*', ''))
             else:
                 regex_subs.append((r'add_subdirectory\((.*san|sanitizer_common)\)', ''))
 
             apply_regex_substitutions(cmakelists_tests, regex_subs)
 
+    @contextmanager
+    def restored_stage_env(self):
+        """
+        Restore $PATH, $CFLAGS and $CXXFLAGS (which are modified by build_with_prev_stage) when done,
+        also when building a stage failed, so changes made for one stage never leak into the next one.
+        """
+        orig_env = dict((key, os.getenv(key)) for key in ('PATH', 'CFLAGS', 'CXXFLAGS'))
+        try:
+            yield
+        finally:
+            for key, val in sorted(orig_env.items()):
+                if val is None:
+                    os.environ.pop(key, None)
+                else:
+                    setvar(key, val, verbose=False)
+
     def build_with_prev_stage(self, prev_obj, next_obj):
         """Build Clang stage N using Clang stage N-1"""
 
@@ -506,11 +698,6 @@ class EB_Clang(CMakeMake):
             my_clang_toolchain.prepare_rpath_wrappers()
             self.log.info("Prepared clang rpath wrappers")
 
-            # add symlink for 'opt' to wrapper dir, since Clang expects it in the same directory
-            # see https://github.com/easybuilders/easybuild-easyblocks/issues/3075
-            clang_wrapper_dir = os.path.dirname(which('clang'))
-            symlink(os.path.join(prev_obj_path, 'opt'), os.path.join(clang_wrapper_dir, 'opt'))
-
             # RPATH wrappers add -Wl,rpath arguments to all command lines, including when it is just compiling
             # Clang by default warns about that, and then some configure tests use -Werror which turns those warnings
             # into errors. As a result, those configure tests fail, even though the compiler supports the requested
@@ -527,34 +714,95 @@ class EB_Clang(CMakeMake):
         clang = which('clang')
         clangxx = which('clang++')
 
+        if build_option('rpath'):
+            # add symlink for 'opt' to wrapper dir, since Clang expects it in the same directory
+            # see https://github.com/easybuilders/easybuild-easyblocks/issues/3075
+            symlink(os.path.join(prev_obj_path, 'opt'), os.path.join(os.path.dirname(clang), 'opt'))
+
         # Configure.
         options = [
-            "-DCMAKE_INSTALL_PREFIX=%s " % self.installdir,
-            "-DCMAKE_C_COMPILER='%s' " % clang,
-            "-DCMAKE_CXX_COMPILER='%s' " % clangxx,
+            "-DCMAKE_INSTALL_PREFIX='%s'" % self.installdir,
+            "-DCMAKE_C_COMPILER='%s'" % clang,
+            "-DCMAKE_CXX_COMPILER='%s'" % clangxx,
             self.cfg['configopts'],
-            "-DCMAKE_BUILD_TYPE=%s " % self.build_type,
+            # stage 1 may have been built for a subset of the build targets (see configure_step),
+            # this overrides the list of build targets that is included in configopts
+            '-DLLVM_TARGETS_TO_BUILD="%s"' % ';'.join(self.cfg['build_targets']),
         ]
 
+        # don't override the build type that is already specified in configopts
+        # (either by the easyconfig, or by the configure step for stage 1)
+        if '-DCMAKE_BUILD_TYPE=' not in self.cfg['configopts']:
+            options.append("-DCMAKE_BUILD_TYPE=%s" % self.build_type)
+
         # Cmake looks for llvm-link by default in the same directory as the compiler
         # However, when compiling with rpath, the clang 'compiler' is not actually the compiler, but the wrapper
         # Clearly, the wrapper directory won't llvm-link. Thus, we pass the linker to be used by full path.
         # See https://github.com/easybuilders/easybuild-easyblocks/pull/2799#issuecomment-1275916186
         if build_option('rpath'):
-            llvm_link = which('llvm-link')
-            options.append("-DLIBOMPTARGET_NVPTX_BC_LINKER=%s" % llvm_link)
+            llvm_link = os.path.join(prev_obj_path, 'llvm-link')
+            options.append("-DLIBOMPTARGET_NVPTX_BC_LINKER='%s'" % llvm_link)
+
+        # Clang header modules are not supported by GCC, so they can only be used for stage 2 and 3;
+        # they avoid that the same (large) LLVM headers are parsed over and over again for every source file
+        if self.cfg['use_clang_modules']:
+            options.append("-DLLVM_ENABLE_MODULES=ON")
+            options.append("-DLLVM_ENABLE_MODULE_DEBUGGING=OFF")
+
+        # Use ThinLTO for stage 2 and 3 (if desired), which yields a faster final compiler;
+        # this requires lld and llvm-ar/llvm-ranlib from the previous stage to deal with the LLVM bitcode files
+        if self.cfg['bootstrap_thin_lto']:
+            options.append("-DLLVM_ENABLE_LTO=Thin")
+            options.append("-DLLVM_USE_LINKER=lld")
+            options.append("-DCMAKE_AR='%s'" % os.path.join(prev_obj_path, 'llvm-ar'))
+            options.append("-DCMAKE_RANLIB='%s'" % os.path.join(prev_obj_path, 'llvm-ranlib'))
+        elif not LLVM_USE_LINKER_REGEX.search(self.cfg['configopts']):
+            # use a faster linker than the default ld.bfd (unless a linker was specified in configopts):
+            # lld if it was built in the previous stage, or else ld.gold if it is available
+            if os.path.exists(os.path.join(prev_obj_path, 'ld.lld')):
+                options.append("-DLLVM_USE_LINKER=lld")
+            elif which('ld.gold'):
+                options.append("-DLLVM_USE_LINKER=gold")
+
+        # The ccache symlinks that are put in place when --use-ccache is used only cover the compilers of the
+        # toolchain (used for stage 1), so we let CMake use ccache as launcher for the Clang compilers of the
+        # previous stage (ccache itself is configured via $CCACHE_DIR, which is set by EasyBuild)
+        if build_option('use_ccache'):
+            ccache = which('ccache')
+            options.append("-DCMAKE_C_COMPILER_LAUNCHER='%s'" % ccache)
+            options.append("-DCMAKE_CXX_COMPILER_LAUNCHER='%s'" % ccache)
+
+        # stage 3 is configured with the same options as stage 2, and with a Clang compiler built from the same sources,
+        # so the CMake cache can be seeded with the results of the checks for system features (HAVE_*) of stage 2,
+        # which avoids that all of those checks are done again (results for stage 1 can't be used: built with GCC)
+        if prev_obj != self.llvm_obj_dir_stage1:
+            prev_cmake_cache = os.path.join(prev_obj, 'CMakeCache.txt')
+            if os.path.exists(prev_cmake_cache):
+                cache_vars = CMAKE_CACHE_HAVE_VAR_REGEX.findall(read_file(prev_cmake_cache))
+                cache_init_lines = []
+                for (name, var_type, value) in cache_vars:
+                    value = value.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+                    cache_init_lines.append('set(%s "%s" CACHE %s "")' % (name, value, var_type))
+                cache_init = os.path.join(next_obj, 'cache_init.cmake')
+                write_file(cache_init, '\n'.join(cache_init_lines) + '\n')
+                self.log.info("Seeding CMake cache with %d results of checks from %s", len(cache_vars), prev_obj)
+                options.append("-C '%s'" % cache_init)
+
+        # use same generator as for stage 1
+        if self.cfg['generator']:
+            options.insert(0, '-G "%s"' % self.cfg['generator'])
 
         self.log.info("Configuring")
         if LooseVersion(self.version) >= LooseVersion('14'):
-            run_cmd("cmake %s %s" % (' '.join(options), os.path.join(self.llvm_src_dir, "llvm")), log_all=True)
+            run_cmd("cmake %s '%s'" % (' '.join(options), os.path.join(self.llvm_src_dir, "llvm")), log_all=True)
         else:
-            run_cmd("cmake %s %s" % (' '.join(options), self.llvm_src_dir), log_all=True)
+            run_cmd("cmake %s '%s'" % (' '.join(options), self.llvm_src_dir), log_all=True)
 
         self.log.info("Building")
-        run_cmd("make %s VERBOSE=1" % self.make_parallel_opts, log_all=True)
-
-        # restore $PATH
-        setvar('PATH', orig_path)
+        if self.cfg['generator'] == 'Ninja':
+            run_cmd("ninja %s -v" % self.make_parallel_opts, log_all=True)
+        else:
+            run_cmd("make %s VERBOSE=1" % self.make_parallel_opts, log_all=True)
 
     def build_step(self):
         """Build Clang stage 1, 2, 3"""
@@ -566,10 +814,12 @@ class EB_Clang(CMakeMake):
 
         if self.cfg['bootstrap']:
             self.log.info("Building stage 2")
-            self.build_with_prev_stage(self.llvm_obj_dir_stage1, self.llvm_obj_dir_stage2)
+            with self.restored_stage_env():
+                self.build_with_prev_stage(self.llvm_obj_dir_stage1, self.llvm_obj_dir_stage2)
 
             self.log.info("Building stage 3")
-            self.build_with_prev_stage(self.llvm_obj_dir_stage2, self.llvm_obj_dir_stage3)
+            with self.restored_stage_env():
+                self.build_with_prev_stage(self.llvm_obj_dir_stage2, self.llvm_obj_dir_stage3)
 
     def test_step(self):
         """Run Clang tests on final stage (unless disabled)."""
@@ -578,7 +828,8 @@ class EB_Clang(CMakeMake):
                 change_dir(self.llvm_obj_dir_stage3)
             else:
                 change_dir(self.llvm_obj_dir_stage1)
-            run_cmd("make %s check-all" % self.make_parallel_opts, log_all=True)
+            build_tool = 'ninja' if self.cfg['generator'] == 'Ninja' else 'make'
+            run_cmd("%s %s check-all" % (build_tool, self.make_parallel_opts), log_all=True)
 
     def install_step(self):
         """Install stage 3 binaries."""
@@ -649,8 +900,15 @@ class EB_Clang(CMakeMake):
             print_warning("Unknown CPU architecture (%s) for OpenMP and runtime libraries check!" % arch)
 
         if version >= '14':
-            glob_pattern = os.path.join(self.installdir, 'lib', '%s-*' % arch)
-            matches = glob.glob(glob_pattern)
+            # check for the most common target triples first, only scan the lib directory if that fails
+            matches = []
+            for suffix in ['unknown-linux-gnu', 'pc-linux-gnu', 'linux-gnu']:
+                cand_dir = os.path.join(self.installdir, 'lib', '%s-%s' % (arch, suffix))
+                if os.path.isdir(cand_dir):
+                    matches = [cand_dir]
+                    break
+            if not matches:
+                matches = glob.glob(os.path.join(self.installdir, 'lib', '%s-*' % arch))
             if matches:
                 directory = os.path.basename(matches[0])
                 self.runtime_lib_path = os.path.join("lib", directory)
@@ -707,17 +965,16 @@ class EB_Clang(CMakeMake):
             omp_target_libs = ["lib/libomptarget.%s" % shlib_ext]
         custom_paths['files'].extend(omp_target_libs)
 
+        build_targets = self.cfg['build_targets']
+
         # If building for CUDA check that OpenMP target library was created
-        if 'NVPTX' in self.cfg['build_targets']:
+        if 'NVPTX' in build_targets:
             custom_paths['files'].append("lib/libomptarget.rtl.cuda.%s" % shlib_ext)
             # The static 'nvptx.a' library is not built from version 12 onwards
             if version < '12.0':
                 custom_paths['files'].append("lib/libomptarget-nvptx.a")
-            ec_cuda_cc = self.cfg['cuda_compute_capabilities']
-            cfg_cuda_cc = build_option('cuda_compute_capabilities')
-            cuda_cc = cfg_cuda_cc or ec_cuda_cc or []
             # We need the CUDA capability in the form of '75' and not '7.5'
-            cuda_cc = [cc.replace('.', '') for cc in cuda_cc]
+            cuda_cc = [cc.replace('.', '') for cc in self.get_cuda_compute_capabilities()]
             if '12.0' < version < '13.0':
                 custom_paths['files'].extend(["lib/libomptarget-nvptx-cuda_%s-sm_%s.bc" % (x, y)
                                              for x in CUDA_TOOLKIT_SUPPORT for y in cuda_cc])
@@ -734,7 +991,7 @@ class EB_Clang(CMakeMake):
                 custom_paths['files'].extend(["lib/libomptarget-new-nvptx-sm_%s.bc" % cc
                                               for cc in cuda_cc])
         # If building for AMDGPU check that OpenMP target library was created
-        if 'AMDGPU' in self.cfg['build_targets']:
+        if 'AMDGPU' in build_targets:
             custom_paths['files'].append("lib/libLLVMAMDGPUCodeGen.a")
             # OpenMP offloading support to AMDGPU was not added until version
             # 13, however, building for the AMDGPU target predates this and so
@@ -752,6 +1009,10 @@ class EB_Clang(CMakeMake):
             custom_paths['files'].extend([os.path.join("lib", "python", "clang", "cindex.py")])
             custom_commands.extend(["python -c 'import clang'"])
 
+        # filter out duplicates (retaining order), to avoid checking the same path multiple times
+        custom_paths['files'] = nub(custom_paths['files'])
+        custom_paths['dirs'] = nub(custom_paths['dirs'])
+
         super(EB_Clang, self).sanity_check_step(custom_paths=custom_paths, custom_commands=custom_commands)
 
     def make_module_extra(self):
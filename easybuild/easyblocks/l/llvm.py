@@ -31,6 +31,7 @@ EasyBuild support for building and installing LLVM, implemented as an easyblock
 import os
 
 from easybuild.easyblocks.clang import CLANG_TARGETS, DEFAULT_TARGETS_MAP
+from easybuild.easyblocks.clang import det_llvm_build_type_configopts, setup_llvm_ninja
 from easybuild.easyblocks.generic.cmakemake import CMakeMake
 from easybuild.framework.easyconfig import CUSTOM
 from easybuild.tools.build_log import EasyBuildError
@@ -69,7 +70,8 @@ class EB_LLVM(CMakeMake):
 
     def configure_step(self):
         """
-        Install extra tools in bin/; enable zlib if it is a dep; optionally enable rtti; and set the build target
+        Install extra tools in bin/; enable zlib if it is a dep; optionally enable rtti; set the build target;
+        and use Ninja as build tool if it is available
         """
         if LooseVersion(self.version) >= LooseVersion('14'):
             self.cfg.update('configopts', '-DLLVM_INCLUDE_BENCHMARKS=OFF')
@@ -84,6 +86,8 @@ class EB_LLVM(CMakeMake):
         if self.cfg["enable_rtti"]:
             self.cfg.update('configopts', '-DLLVM_ENABLE_RTTI=ON')
 
+        self.cfg.update('configopts', det_llvm_build_type_configopts(self.build_type))
+
         build_targets = self.cfg['build_targets']
         if build_targets is None:
             arch = get_cpu_architecture()
@@ -121,4 +125,6 @@ class EB_LLVM(CMakeMake):
                 raise EasyBuildError("Failed to find unpacked 'third-party' modules directory at %s",
                                      third_party_modules_path)
 
+        setup_llvm_ninja(self)
+
         super(EB_LLVM, self).configure_step()
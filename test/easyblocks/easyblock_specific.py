@@ -37,6 +37,8 @@ from unittest import TestLoader, TextTestRunner
 from test.easyblocks.module import cleanup
 
 import easybuild.tools.options as eboptions
+import easybuild.tools.systemtools as systemtools
+import easybuild.easyblocks.clang as clang
 import easybuild.easyblocks.generic.pythonpackage as pythonpackage
 from easybuild.base.testing import TestCase
 from easybuild.easyblocks.generic.cmakemake import det_cmake_version
@@ -266,6 +268,32 @@ class EasyBlockSpecificTest(TestCase):
         """))
         self.assertEqual(det_cmake_version(), '1.2.3-rc4')
 
+    def test_det_llvm_parallel_jobs(self):
+        """Tests for det_llvm_parallel_jobs function provided along with Clang easyblock."""
+
+        orig_get_total_memory = clang.get_total_memory
+        try:
+            # if total memory can't be determined, only number of link jobs is limited based on 'parallel'
+            clang.get_total_memory = lambda: systemtools.UNKNOWN
+            self.assertEqual(clang.det_llvm_parallel_jobs(1), (1, 1))
+            self.assertEqual(clang.det_llvm_parallel_jobs(16), (16, 4))
+
+            # 32GB of memory
+            clang.get_total_memory = lambda: 32 * 1024
+            self.assertEqual(clang.det_llvm_parallel_jobs(8), (8, 2))
+            self.assertEqual(clang.det_llvm_parallel_jobs(64), (16, 2))
+
+            # 512GB of memory
+            clang.get_total_memory = lambda: 512 * 1024
+            self.assertEqual(clang.det_llvm_parallel_jobs(16), (16, 16))
+            self.assertEqual(clang.det_llvm_parallel_jobs(128), (128, 34))
+
+            # always at least one compile/link job, even with very little memory
+            clang.get_total_memory = lambda: 1024
+            self.assertEqual(clang.det_llvm_parallel_jobs(4), (1, 1))
+        finally:
+            clang.get_total_memory = orig_get_total_memory
+
     def test_det_py_install_scheme(self):
         """Test det_py_install_scheme function provided by PythonPackage easyblock."""
         res = pythonpackage.det_py_install_scheme(sys.executable)